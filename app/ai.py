@@ -1,22 +1,109 @@
-import json
 import re
 import time
+import asyncio
+import hashlib
 import logging
+import random
+import threading
+from collections import OrderedDict, deque
+from collections.abc import AsyncIterator, Iterator
+from typing import Protocol
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+import httpx
+import orjson
 from google import genai
-from google.genai import types
-from config import GEMINI_API_KEY
+from google.genai import errors, types
+from config import GEMINI_API_KEY, HISTORY_DB_PATH
+from history import ClassifyStore, HistoryStore
 
 logger = logging.getLogger(__name__)
 
-client = genai.Client(api_key=GEMINI_API_KEY)
+# One pooled HTTP client for every Gemini call. httpx drops idle connections
+# after 5s by default, so with calls minutes apart nearly every request paid a
+# fresh TCP+TLS handshake; keep them alive across the scheduler's 1-min ticks.
+client = genai.Client(
+    api_key=GEMINI_API_KEY,
+    http_options=types.HttpOptions(client_args={
+        "limits": httpx.Limits(max_keepalive_connections=20, max_connections=40, keepalive_expiry=120),
+    }),
+)
+
+# Shared SDK handles: client.chats builds a fresh Chats factory on every access
+_models = client.models
+_chats = client.chats
 
 PRIMARY_MODEL = "gemini-2.5-flash-lite"
 FALLBACK_MODEL = "gemini-2.5-flash"
+MODEL_ORDER = (PRIMARY_MODEL, FALLBACK_MODEL)
 
 CATEGORIES = ["work", "personal", "health", "other"]
-
-# In-memory conversation history per user
-_histories: dict[int, list] = {}
+_CATEGORIES_SET = frozenset(CATEGORIES)
+
+
+class TaskLike(Protocol):
+    """What the generate_* functions read: a models.Task, or a Row from a
+    select()/RETURNING over its columns. overdue_count is optional (0), as is
+    the scheduler's update_flag (which alert this is)."""
+
+    text: str
+    category: str
+
+
+# Dedicated threads for the blocking calls below when made from async code,
+# sized to the Gemini concurrency budget so bursts queue instead of piling up
+# on the default executor.
+AI_WORKERS = 8
+_ai_executor = ThreadPoolExecutor(max_workers=AI_WORKERS, thread_name_prefix="gemini")
+
+# Hedged single-turn calls: if the primary hasn't answered within HEDGE_DELAY
+# seconds (or failed), the fallback is fired too and the first success wins.
+# Every AI worker can have both models in flight at once.
+HEDGE_DELAY = 1.5
+_hedge_pool = ThreadPoolExecutor(max_workers=2 * AI_WORKERS, thread_name_prefix="gemini-hedge")
+
+# 429 handling: wait what Gemini's RetryInfo asks for (capped), otherwise back
+# off exponentially with jitter; one retry per entry.
+RATE_LIMIT_BACKOFF = (1, 2, 4, 8)
+MAX_RETRY_DELAY = 30
+
+# Single-flight: blake2b(prompt) -> Future shared by every caller of that prompt
+_inflight: dict[str, Future] = {}
+_inflight_lock = threading.Lock()
+
+# Client-side quota per model (Gemini free tier): (requests/min, tokens/min)
+MODEL_LIMITS = {
+    PRIMARY_MODEL: (15, 250_000),
+    FALLBACK_MODEL: (10, 250_000),
+}
+
+# Conversation history per user: persisted to SQLite, read back only to seed
+# the in-memory deque below
+MAX_CHAT_USERS = 1000
+CHAT_HISTORY_TURNS = 3
+_histories = HistoryStore(HISTORY_DB_PATH, turns=CHAT_HISTORY_TURNS)
+
+# The one in-memory copy of those turns, as ready-made Content: appended once
+# per turn and handed to a fresh Chat each turn (Chat objects are client-side only)
+_gemini_histories: OrderedDict[int, deque[types.Content]] = OrderedDict()
+_gemini_histories_lock = threading.Lock()
+
+# classify_task response cache: normalized text -> (stored_at, result)
+CLASSIFY_CACHE_SIZE = 4096
+CLASSIFY_CACHE_TTL = 24 * 60 * 60  # seconds
+# Written behind to the same SQLite file as chat history, so a redeploy starts warm
+_classify_store = ClassifyStore(HISTORY_DB_PATH, size=CLASSIFY_CACHE_SIZE, ttl=CLASSIFY_CACHE_TTL)
+# sha256(normalized text) -> (stored_at, result); digests keep long task texts out of memory.
+# stored_at is wall-clock time so persisted entries keep their age across restarts.
+_classify_cache: OrderedDict[bytes, tuple[float, dict]] = OrderedDict(
+    (key, (stored_at, orjson.loads(data))) for key, stored_at, data in _classify_store.load()
+)
+_classify_lock = threading.Lock()
+_classify_stats = {"hits": 0, "misses": 0}
+
+# generate_* reply cache: (kind, category, tone bucket) -> normalized key -> reply
+REPLY_CACHE_SIZE = 512  # per namespace
+_reply_cache: dict[tuple, OrderedDict[str, str]] = {}
+_reply_lock = threading.Lock()
 
 # ─────────────────────────────────────────────
 # BOSS PERSONALITY — core system prompt
@@ -32,55 +119,413 @@ Rules:
 5. If they finish a task, praise briefly then ask what's next.
 """.strip()
 
+_CHAT_CONFIG = types.GenerateContentConfig(system_instruction=BOSS_SYSTEM_PROMPT)
+
+# ─────────────────────────────────────────────
+# PROMPT TEMPLATES — static parts built once at import
+# ─────────────────────────────────────────────
+
+def _with_note(header: str, note: str) -> str:
+    return f"{header}\n{note}" if note else header
+
+
+_CLASSIFY_HEADER = """
+You are TaskManagerBoss, a strict task classifier. Analyze this task and return ONLY a JSON object.
+No explanation. No markdown fences. No extra text. ONLY the raw JSON.
+""".strip()
+
+# Language instructions per script of the user's text (see detect_lang):
+# only ambiguous Cyrillic needs the long Uzbek-vs-Russian disambiguation.
+_CLASSIFY_LANG_NOTES = {
+    "uz_cyr": "LANGUAGE NOTE: The task is in Uzbek (Cyrillic script), not Russian.",
+    "cyrillic": "LANGUAGE NOTE: The task may be in Uzbek (not Russian) — Uzbek and Russian both use Cyrillic but are different languages.",
+    "latin": "",
+}
+
+_CLASSIFY_FOOTER = f"""
+Return JSON with exactly these keys:
+- "category": one of {CATEGORIES}
+- "short_title": clean 3-7 word title summarizing the task, written in the SAME LANGUAGE as the task (if task is Uzbek → Uzbek, Russian → Russian, English → English)
+- "due_hint": deadline as YYYY-MM-DD HH:MM string if mentioned, or null if no deadline
+
+Rules:
+- "work" = anything related to job, career, office, business, meetings, projects, coding, clients
+- "personal" = errands, shopping, family, friends, hobbies, finances
+- "health" = exercise, gym, doctor, medication, sleep, diet, mental health
+- "other" = anything that doesn't clearly fit above
+""".strip()
+
+# Reminder tone by overdue_count (3 = three or more): (tone, example)
+TONE_TABLE: dict[int, tuple[str, str]] = {
+    0: (
+        "firm and professional — first reminder, be direct but not harsh",
+        "Hey, you have a pending task. When are you planning to finish it?",
+    ),
+    1: (
+        "noticeably impatient — this is the second time you're reminding them",
+        "I already reminded you once. This task is still sitting there. What's the holdup?",
+    ),
+    2: (
+        "sarcastic and disappointed — like a boss who's losing patience",
+        "Third reminder. At this point I'm wondering if you even want to do this.",
+    ),
+    3: (
+        "very aggressive and fed up — like an angry boss who's had enough. Use caps for emphasis",
+        "This is STILL not done?! I've reminded you multiple times. No more excuses.",
+    ),
+}
+
+_REMINDER_INTRO = """
+You are TaskManagerBoss — a strict, no-nonsense task manager.
+Write a reminder message. Respond in the SAME language as the task text.
+""".strip()
+
+_REMINDER_LANG_NOTES = {
+    "uz_cyr": "The task is in Uzbek (Cyrillic script): write in UZBEK, NOT Russian.",
+    "cyrillic": "CRITICAL: If the task is in Uzbek, write in UZBEK (NOT Russian). Uzbek and Russian both use Cyrillic but are different languages. If English, write in English.",
+    "latin": "",
+}
+
+_REMINDER_TONE = 'Tone: {}\nExample of the tone: "{}"'
+
+_REMINDER_HEADERS = {
+    (bucket, lang): f"{_with_note(_REMINDER_INTRO, note)}\n\n{_REMINDER_TONE.format(*tone)}"
+    for bucket, tone in TONE_TABLE.items()
+    for lang, note in _REMINDER_LANG_NOTES.items()
+}
+
+_REMINDER_FOOTER = """
+Write 2-3 sentences MAX. End by telling them to press ✅ if done or ❌ if not done yet.
+Stay in character as a demanding boss. Don't be a polite assistant.
+""".strip()
+
+# Shared by the why and done replies
+_REPLY_LANG_NOTES = {
+    "uz_cyr": "The text is in Uzbek (Cyrillic script): use informal 'sen' form and respond in UZBEK, NOT Russian.",
+    "cyrillic": "CRITICAL: If Uzbek (Cyrillic but NOT Russian), use informal 'sen' form and respond in UZBEK. If English, be direct.",
+    "latin": "If Uzbek, use informal 'sen' form. If English, be direct.",
+}
+
+_WHY_HEADER = """
+You are TaskManagerBoss — a strict but fair boss.
+Respond in the SAME language as the task/reason text.
+""".strip()
+
+_WHY_FOOTER = """
+React like a REAL boss hearing an excuse:
+- If the reason is legitimate → acknowledge briefly, but set a NEW deadline. "Fine, but I want this done by tomorrow."
+- If the reason is weak/lazy → call it out. "That's not a real reason. Get it done."
+- Either way, end by pushing them to do it NOW.
+
+Max 2-3 sentences. No motivational speeches. Be direct.
+""".strip()
+
+_DONE_HEADER = """
+You are TaskManagerBoss — a strict but fair boss.
+Respond in the SAME language as the task text.
+""".strip()
+
+_DONE_FOOTER = """
+React like a boss who's satisfied but doesn't overdo praise:
+- Brief, genuine acknowledgment (1-2 sentences)
+- Something like "Good work. That's what I like to see." or "About time! But good job."
+- Then ask: "What's the next task?" or similar push to keep going
+
+Don't write a motivational essay. Stay in character.
+""".strip()
+
+# Per-template request configs: the invariant instructions travel as the
+# system instruction (a stable prefix), the per-call details as contents.
+# One variant per script, so the language instructions match the input.
+_CLASSIFY_CONFIGS = {
+    lang: types.GenerateContentConfig(
+        system_instruction=f"{_with_note(_CLASSIFY_HEADER, note)}\n\n{_CLASSIFY_FOOTER}"
+    )
+    for lang, note in _CLASSIFY_LANG_NOTES.items()
+}
+_REMINDER_CONFIGS = {
+    key: types.GenerateContentConfig(system_instruction=f"{header}\n\n{_REMINDER_FOOTER}")
+    for key, header in _REMINDER_HEADERS.items()
+}
+_WHY_CONFIGS = {
+    lang: types.GenerateContentConfig(
+        system_instruction=f"{_with_note(_WHY_HEADER, note)}\n\n{_WHY_FOOTER}"
+    )
+    for lang, note in _REPLY_LANG_NOTES.items()
+}
+_DONE_CONFIGS = {
+    lang: types.GenerateContentConfig(
+        system_instruction=f"{_with_note(_DONE_HEADER, note)}\n\n{_DONE_FOOTER}"
+    )
+    for lang, note in _REPLY_LANG_NOTES.items()
+}
+
+
+class _RateLimiter:
+    """Blocks callers locally instead of letting Gemini answer with a 429.
+
+    Requests are metered by a token bucket refilled continuously at rpm/60 per
+    second; tokens by a rolling 60s window of usage_metadata totals.
+    """
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._lock = threading.Lock()
+        self._allowance = float(rpm)
+        self._refilled_at = time.monotonic()
+        self._usage: deque[tuple[float, int]] = deque()
+        self._used = 0
+
+    def _reserve(self, now: float) -> float:
+        """Take one request slot, or return how long to wait for one."""
+        self._allowance = min(self.rpm, self._allowance + (now - self._refilled_at) * self.rpm / 60)
+        self._refilled_at = now
+        while self._usage and self._usage[0][0] <= now - 60:
+            self._used -= self._usage.popleft()[1]
+
+        delay = 0.0
+        if self._allowance < 1:
+            delay = (1 - self._allowance) * 60 / self.rpm
+        if self._used >= self.tpm:
+            delay = max(delay, self._usage[0][0] + 60 - now)
+        if delay <= 0:
+            self._allowance -= 1
+        return delay
+
+    def acquire(self, cancelled: threading.Event | None = None) -> bool:
+        """Wait for a request slot; False if `cancelled` was set first."""
+        cancelled = cancelled or threading.Event()
+        while not cancelled.is_set():
+            with self._lock:
+                delay = self._reserve(time.monotonic())
+            if delay <= 0:
+                return True
+            cancelled.wait(delay)
+        return False
+
+    def record(self, response: types.GenerateContentResponse):
+        usage = response.usage_metadata
+        tokens = (usage.total_token_count if usage else None) or 0
+        with self._lock:
+            self._usage.append((time.monotonic(), tokens))
+            self._used += tokens
+
+
+_limiters = {name: _RateLimiter(rpm, tpm) for name, (rpm, tpm) in MODEL_LIMITS.items()}
+
 
 def _is_rate_limit(e: Exception) -> bool:
+    if isinstance(e, errors.APIError) and e.code == 429:
+        return True
     msg = str(e).lower()
     return "429" in msg or "quota" in msg or "rate" in msg or "exhausted" in msg
 
 
-def _call(prompt: str) -> str:
-    """Single-turn Gemini call with fallback and rate-limit retry."""
-    for model_name in [PRIMARY_MODEL, FALLBACK_MODEL]:
-        for attempt in range(2):
+def _server_retry_delay(e: Exception) -> float | None:
+    """The wait Gemini asked for: RetryInfo.retryDelay ("31s") or Retry-After."""
+    if not isinstance(e, errors.APIError):
+        return None
+    error = e.details.get("error", {}) if isinstance(e.details, dict) else {}
+    for detail in error.get("details", []):
+        delay = detail.get("retryDelay") if isinstance(detail, dict) else None
+        if isinstance(delay, str) and delay.endswith("s"):
             try:
-                response = client.models.generate_content(
-                    model=model_name,
-                    contents=prompt,
-                )
-                return response.text.strip()
-            except Exception as e:
-                if _is_rate_limit(e):
-                    if attempt == 0:
-                        logger.warning(f"{model_name} rate limited, retrying in 35s...")
-                        time.sleep(35)
-                    else:
-                        logger.warning(f"{model_name} still rate limited, trying fallback...")
-                        break
-                else:
-                    logger.warning(f"{model_name} failed: {e}")
-                    break
-    raise RuntimeError("All Gemini models failed or rate limited")
-
+                return float(delay[:-1])
+            except ValueError:
+                pass
+    headers = getattr(e.response, "headers", None)
+    retry_after = headers.get("retry-after") if headers else None
+    try:
+        return float(retry_after) if retry_after else None
+    except ValueError:
+        return None
+
+
+def _retry_delay(e: Exception, attempt: int) -> float:
+    """Seconds to wait before retry number `attempt` (0-based) after a 429."""
+    delay = _server_retry_delay(e)
+    if delay is None:
+        # No hint from the server: exponential backoff with full jitter
+        delay = random.uniform(0, RATE_LIMIT_BACKOFF[min(attempt, len(RATE_LIMIT_BACKOFF) - 1)])
+    return min(delay, MAX_RETRY_DELAY)
+
+
+def _generate(
+    model_name: str,
+    prompt: str,
+    config: types.GenerateContentConfig | None,
+    settled: threading.Event | None = None,
+) -> str:
+    """One generate_content call; skipped if `settled` is set while waiting on the limiter."""
+    limiter = _limiters[model_name]
+    if not limiter.acquire(settled):
+        raise RuntimeError(f"{model_name} call skipped, hedge already settled")
+    response = _models.generate_content(
+        model=model_name,
+        contents=prompt,
+        config=config,
+    )
+    limiter.record(response)
+    text = (response.text or "").strip()
+    if not text:
+        raise RuntimeError(f"{model_name} returned an empty reply")
+    return text
+
+
+def _hedged_generate(prompt: str, config: types.GenerateContentConfig | None) -> str:
+    """Race the fallback against a slow or failing primary; first success wins."""
+    # Set once a winner is returned, so a loser still queued on its rate
+    # limiter gives up instead of spending a request nobody reads.
+    settled = threading.Event()
+    primary = _hedge_pool.submit(_generate, PRIMARY_MODEL, prompt, config, settled)
+    done, _ = wait([primary], timeout=HEDGE_DELAY)
+    if done and primary.exception() is None:
+        return primary.result()
+    if not done:
+        logger.info(f"{PRIMARY_MODEL} slow, hedging with {FALLBACK_MODEL}")
+
+    fallback = _hedge_pool.submit(_generate, FALLBACK_MODEL, prompt, config, settled)
+    models: dict[Future, str] = {primary: PRIMARY_MODEL, fallback: FALLBACK_MODEL}
+    pending = set(models)
+    failures: list[Exception] = []
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            error = future.exception()
+            if error is None:
+                settled.set()
+                for loser in pending:
+                    loser.cancel()
+                return future.result()
+            logger.warning(f"{models[future]} failed: {error}")
+            failures.append(error)
+    # Only report a rate limit when every model was rate limited
+    raise next((e for e in failures if not _is_rate_limit(e)), failures[0])
+
+
+def _do_call(prompt: str, config: types.GenerateContentConfig | None) -> str:
+    """Single-turn Gemini call, hedged across models, with rate-limit retries."""
+    for attempt in range(len(RATE_LIMIT_BACKOFF) + 1):
+        try:
+            return _hedged_generate(prompt, config)
+        except Exception as e:
+            if attempt < len(RATE_LIMIT_BACKOFF) and _is_rate_limit(e):
+                delay = _retry_delay(e, attempt)
+                logger.warning(f"All models rate limited, retrying in {delay:.1f}s...")
+                time.sleep(delay)
+            else:
+                raise RuntimeError("All Gemini models failed or rate limited") from e
+
+
+def _call(prompt: str, config: types.GenerateContentConfig | None = None) -> str:
+    """_do_call(), with concurrent identical prompts sharing a single request.
+
+    Static instructions belong in config.system_instruction (built once at
+    import) so only the short dynamic part is sent as the prompt.
+    """
+    instruction = config.system_instruction if config else ""
+    key = hashlib.blake2b(f"{instruction}\0{prompt}".encode(), digest_size=16).hexdigest()
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = _inflight[key] = Future()
+    if not leader:
+        return future.result()
 
-def _chat_call(history: list[types.Content], message: str) -> str:
-    """Multi-turn Gemini chat call with system instruction, fallback and retry."""
-    for model_name in [PRIMARY_MODEL, FALLBACK_MODEL]:
+    try:
+        result = _do_call(prompt, config)
+        future.set_result(result)
+        return result
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+
+
+def _turn_contents(enhanced_message: str, bot: str) -> tuple[types.Content, types.Content]:
+    return (
+        types.Content(role="user", parts=[types.Part(text=enhanced_message)]),
+        types.Content(role="model", parts=[types.Part(text=bot)]),
+    )
+
+
+def _gemini_history(user_id: int) -> deque[types.Content]:
+    """Caller must hold _gemini_histories_lock. Built from saved turns on first use only."""
+    contents = _gemini_histories.get(user_id)
+    if contents is None:
+        contents = deque(maxlen=2 * CHAT_HISTORY_TURNS)
+        for _, enhanced_message, bot in _histories.load(user_id):
+            contents.extend(_turn_contents(enhanced_message, bot))
+        _gemini_histories[user_id] = contents
+    _gemini_histories.move_to_end(user_id)
+    while len(_gemini_histories) > MAX_CHAT_USERS:
+        _gemini_histories.popitem(last=False)
+    return contents
+
+
+def _call_stream(prompt: str, config: types.GenerateContentConfig | None = None) -> Iterator[str]:
+    """Yield reply text chunks as Gemini produces them.
+
+    Falls back to the next model only while nothing has been yielded yet;
+    a failure mid-stream is raised to the caller.
+    """
+    last_error: Exception | None = None
+    for model_name in MODEL_ORDER:
+        limiter = _limiters[model_name]
+        limiter.acquire()
+        started = False
+        try:
+            last_chunk = None
+            for chunk in _models.generate_content_stream(
+                model=model_name,
+                contents=prompt,
+                config=config,
+            ):
+                last_chunk = chunk
+                if chunk.text:
+                    started = True
+                    yield chunk.text
+            if last_chunk is not None:
+                limiter.record(last_chunk)  # usage totals arrive on the last chunk
+            return
+        except Exception as e:
+            if started:
+                raise
+            logger.warning(f"{model_name} stream failed: {e}")
+            last_error = e
+    raise RuntimeError("All Gemini models failed or rate limited") from last_error
+
+
+def _history_contents(user_id: int) -> list[types.Content]:
+    """Snapshot of the user's history for this turn's chat."""
+    with _gemini_histories_lock:
+        return list(_gemini_history(user_id))
+
+
+def _chat_call(user_id: int, message: str) -> str:
+    """Multi-turn Gemini chat call over the user's saved turns, with fallback and retry."""
+    for model_name in MODEL_ORDER:
         for attempt in range(2):
             try:
-                chat_session = client.chats.create(
+                session = _chats.create(
                     model=model_name,
-                    config=types.GenerateContentConfig(
-                        system_instruction=BOSS_SYSTEM_PROMPT,
-                    ),
-                    history=history,
+                    config=_CHAT_CONFIG,
+                    history=_history_contents(user_id),
                 )
-                response = chat_session.send_message(message)
+                _limiters[model_name].acquire()
+                response = session.send_message(message)
+                _limiters[model_name].record(response)
                 return response.text.strip()
             except Exception as e:
                 if _is_rate_limit(e):
                     if attempt == 0:
-                        logger.warning(f"{model_name} rate limited, retrying in 35s...")
-                        time.sleep(35)
+                        delay = _retry_delay(e, attempt)
+                        logger.warning(f"{model_name} rate limited, retrying in {delay:.1f}s...")
+                        time.sleep(delay)
                     else:
                         logger.warning(f"{model_name} still rate limited, trying fallback...")
                         break
@@ -90,6 +535,101 @@ def _chat_call(history: list[types.Content], message: str) -> str:
     raise RuntimeError("All Gemini models failed or rate limited")
 
 
+def _strip_fences(raw: str) -> str:
+    """Drop a ```json ... ``` wrapper the model sometimes adds despite the prompt."""
+    raw = raw.strip()
+    if raw.startswith("```"):
+        newline = raw.find("\n")
+        start = newline + 1 if newline != -1 else 3
+        end = raw.rfind("```")
+        raw = raw[start:end] if end >= start else raw[start:]
+        if newline == -1 and raw[:4].lower() == "json":
+            # Single-line ```json{...}```: the tag is glued to the payload
+            raw = raw[4:]
+    return raw.strip()
+
+
+_UZ_CYRILLIC = frozenset("ўқғҳ")
+_CYRILLIC_RE = re.compile(r"[\u0400-\u04FF]")
+
+
+def detect_lang(text: str) -> str:
+    """
+    Script-level language guess used to pick a prompt variant:
+    "uz_cyr", "cyrillic" or "latin".
+    ў/қ/ғ/ҳ are the Uzbek-specific letters: Russian has none of them, so their
+    presence means Uzbek here (Belarusian ў or Kazakh/Tajik қ/ғ/ҳ would be
+    misread as Uzbek, which this bot doesn't expect to see). Other Cyrillic may
+    be Uzbek or Russian. Latin-script text may be English or Uzbek Latin, so
+    it only drops the Cyrillic disambiguation.
+    """
+    if not _UZ_CYRILLIC.isdisjoint(text.casefold()):
+        return "uz_cyr"
+    if _CYRILLIC_RE.search(text):
+        return "cyrillic"
+    return "latin"
+
+
+def _normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", text.strip().casefold())
+
+
+def _classify_key(task_text: str) -> bytes:
+    return hashlib.sha256(_normalize(task_text).encode()).digest()
+
+
+def _classify_cache_get(key: bytes) -> dict | None:
+    with _classify_lock:
+        entry = _classify_cache.get(key)
+        if entry is not None and time.time() - entry[0] > CLASSIFY_CACHE_TTL:
+            del _classify_cache[key]
+            entry = None
+        if entry is None:
+            _classify_stats["misses"] += 1
+            return None
+        _classify_stats["hits"] += 1
+        _classify_cache.move_to_end(key)
+        return dict(entry[1])
+
+
+def _classify_cache_put(key: bytes, data: dict):
+    stored_at = time.time()
+    with _classify_lock:
+        _classify_cache[key] = (stored_at, dict(data))
+        _classify_cache.move_to_end(key)
+        while len(_classify_cache) > CLASSIFY_CACHE_SIZE:
+            _classify_cache.popitem(last=False)
+    _classify_store.put(key, stored_at, orjson.dumps(data))
+
+
+def classify_cache_stats() -> dict:
+    """Hit/miss counters and current size of the classify cache."""
+    with _classify_lock:
+        return {**_classify_stats, "size": len(_classify_cache)}
+
+
+def _reply_cache_get(namespace: tuple, key: str) -> str | None:
+    with _reply_lock:
+        return _reply_cache.get(namespace, {}).get(key)
+
+
+def _reply_cache_put(namespace: tuple, key: str, reply: str):
+    with _reply_lock:
+        bucket = _reply_cache.setdefault(namespace, OrderedDict())
+        bucket[key] = reply
+        while len(bucket) > REPLY_CACHE_SIZE:
+            bucket.popitem(last=False)
+
+
+def _cached_call(namespace: tuple, key: str, prompt: str, config: types.GenerateContentConfig) -> str:
+    """_call() memoized per namespace; only successful replies are stored."""
+    reply = _reply_cache_get(namespace, key)
+    if reply is None:
+        reply = _call(prompt, config)
+        _reply_cache_put(namespace, key, reply)
+    return reply
+
+
 def classify_task(task_text: str) -> dict:
     """
     Returns {
@@ -98,140 +638,170 @@ def classify_task(task_text: str) -> dict:
       "due_hint": "YYYY-MM-DD HH:MM" | None
     }
     """
-    prompt = f"""
-You are TaskManagerBoss, a strict task classifier. Analyze this task and return ONLY a JSON object.
-No explanation. No markdown fences. No extra text. ONLY the raw JSON.
-LANGUAGE NOTE: The task may be in Uzbek (not Russian) — Uzbek and Russian both use Cyrillic but are different languages.
-
-Task: "{task_text}"
+    key = _classify_key(task_text)
+    cached = _classify_cache_get(key)
+    if cached is not None:
+        return cached
 
-Return JSON with exactly these keys:
-- "category": one of {CATEGORIES}
-- "short_title": clean 3-7 word title summarizing the task, written in the SAME LANGUAGE as the task (if task is Uzbek → Uzbek, Russian → Russian, English → English)
-- "due_hint": deadline as YYYY-MM-DD HH:MM string if mentioned, or null if no deadline
-
-Rules:
-- "work" = anything related to job, career, office, business, meetings, projects, coding, clients
-- "personal" = errands, shopping, family, friends, hobbies, finances
-- "health" = exercise, gym, doctor, medication, sleep, diet, mental health
-- "other" = anything that doesn't clearly fit above
-""".strip()
-
-    raw = _call(prompt)
-    raw = re.sub(r"```json|```", "", raw).strip()
+    raw = _call(f'Task: "{task_text}"', _CLASSIFY_CONFIGS[detect_lang(task_text)])
+    raw = _strip_fences(raw)
     try:
-        data = json.loads(raw)
-        if data.get("category") not in CATEGORIES:
+        data = orjson.loads(raw)
+        if data.get("category") not in _CATEGORIES_SET:
             data["category"] = "other"
-        return data
     except Exception:
         logger.warning(f"Failed to parse classification JSON: {raw}")
         return {"category": "other", "short_title": task_text[:40], "due_hint": None}
 
+    # Only cache successful parses without a deadline: relative phrases like
+    # "tomorrow" are resolved against the time of the call.
+    if not data.get("due_hint"):
+        _classify_cache_put(key, data)
+    return data
+
 
-def generate_reminder(task: dict) -> str:
+def generate_reminder(task: TaskLike) -> str:
     """Boss-mode reminder. Tone escalates with overdue_count."""
-    count = task.get("overdue_count", 0)
-
-    if count == 0:
-        tone = "firm and professional — first reminder, be direct but not harsh"
-        example = "Hey, you have a pending task. When are you planning to finish it?"
-    elif count == 1:
-        tone = "noticeably impatient — this is the second time you're reminding them"
-        example = "I already reminded you once. This task is still sitting there. What's the holdup?"
-    elif count == 2:
-        tone = "sarcastic and disappointed — like a boss who's losing patience"
-        example = "Third reminder. At this point I'm wondering if you even want to do this."
-    else:
-        tone = "very aggressive and fed up — like an angry boss who's had enough. Use caps for emphasis"
-        example = "This is STILL not done?! I've reminded you multiple times. No more excuses."
-
-    prompt = f"""
-You are TaskManagerBoss — a strict, no-nonsense task manager.
-Write a reminder message. Respond in the SAME language as the task text.
-CRITICAL: If the task is in Uzbek, write in UZBEK (NOT Russian). Uzbek and Russian both use Cyrillic but are different languages. If English, write in English.
+    count = getattr(task, "overdue_count", 0)
+    bucket = min(count, 3)
+
+    prompt = (
+        f'Pending task: "{task.text}"\n'
+        f"Category: {task.category}\n"
+        f"Times reminded already: {count}"
+    )
+    config = _REMINDER_CONFIGS[bucket, detect_lang(task.text)]
+    if count:
+        # Already reminded: a cached body would repeat the same text every
+        # time instead of escalating, so always ask for a fresh one
+        return _call(prompt, config)
+    # A task's first alert of each kind (1h before, at deadline, 48h) has count 0;
+    # keep them apart so one task never gets the same body twice
+    namespace = ("reminder", task.category, getattr(task, "update_flag", None))
+    return _cached_call(namespace, _normalize(task.text), prompt, config)
+
+
+def generate_why_response(task: TaskLike, reason: str) -> str:
+    """Boss response when user says they haven't done a task and gives a reason."""
+    prompt = (
+        f"The user hasn't completed this task: \"{task.text}\"\n"
+        f'Their excuse: "{reason}"'
+    )
+    namespace = ("why", task.category)
+    key = f"{_normalize(task.text)}\n{_normalize(reason)}"
+    config = _WHY_CONFIGS[detect_lang(f"{task.text} {reason}")]
+    return _cached_call(namespace, key, prompt, config)
 
-Tone: {tone}
-Example of the tone: "{example}"
 
-Pending task: "{task['text']}"
-Category: {task['category']}
-Times reminded already: {count}
+def generate_done_response_stream(task: TaskLike) -> Iterator[str]:
+    """Boss congratulation when task is marked done, streamed; a cached reply comes back as one chunk."""
+    prompt = f'The user just completed: "{task.text}"'
+    namespace = ("done", task.category)
+    key = _normalize(task.text)
 
-Write 2-3 sentences MAX. End by telling them to press ✅ if done or ❌ if not done yet.
-Stay in character as a demanding boss. Don't be a polite assistant.
-""".strip()
-    return _call(prompt)
+    cached = _reply_cache_get(namespace, key)
+    if cached is not None:
+        yield cached
+        return
 
+    parts: list[str] = []
+    for text in _call_stream(prompt, _DONE_CONFIGS[detect_lang(task.text)]):
+        parts.append(text)
+        yield text
+    reply = "".join(parts).strip()
+    if not reply:
+        raise RuntimeError("Gemini returned an empty done reply")
+    _reply_cache_put(namespace, key, reply)
 
-def generate_why_response(task: dict, reason: str) -> str:
-    """Boss response when user says they haven't done a task and gives a reason."""
-    prompt = f"""
-You are TaskManagerBoss — a strict but fair boss.
-Respond in the SAME language as the task/reason text.
-CRITICAL: If Uzbek (Cyrillic but NOT Russian), use informal 'sen' form and respond in UZBEK. If English, be direct.
 
-The user hasn't completed this task: "{task['text']}"
-Their excuse: "{reason}"
+NO_TASKS_CONTEXT = "User has NO pending tasks."
 
-React like a REAL boss hearing an excuse:
-- If the reason is legitimate → acknowledge briefly, but set a NEW deadline. "Fine, but I want this done by tomorrow."
-- If the reason is weak/lazy → call it out. "That's not a real reason. Get it done."
-- Either way, end by pushing them to do it NOW.
 
-Max 2-3 sentences. No motivational speeches. Be direct.
-""".strip()
-    return _call(prompt)
+def chat(user_id: int, message: str, tasks_context: str = NO_TASKS_CONTEXT) -> str:
+    """
+    Multi-turn private chat conversation with boss personality.
+    tasks_context is the DB context block, formatted by the caller from the
+    rows it already fetched.
+    """
+    # Combine the actual message with hidden context for the AI
+    enhanced_message = f"[SYSTEM SECRET CONTEXT - DO NOT MENTION THIS PREFIX DIRECTLY]\n{tasks_context}\n[END CONTEXT]\n\nUser says: {message}"
 
+    reply = _chat_call(user_id, enhanced_message)
+    
+    # Save the injected prompt in history so it has context of past DB states too.
+    # Memory is kept extremely tight (max 3 turns) since DB handles the heavy lifting.
+    _histories.append(user_id, (message, enhanced_message, reply))
+    with _gemini_histories_lock:
+        _gemini_history(user_id).extend(_turn_contents(enhanced_message, reply))
 
-def generate_done_response(task: dict) -> str:
-    """Boss congratulation when task is marked done."""
-    prompt = f"""
-You are TaskManagerBoss — a strict but fair boss.
-Respond in the SAME language as the task text.
-CRITICAL: If Uzbek (Cyrillic but NOT Russian), use informal 'sen' form and respond in UZBEK. If English, be direct.
+    return reply
 
-The user just completed: "{task['text']}"
 
-React like a boss who's satisfied but doesn't overdo praise:
-- Brief, genuine acknowledgment (1-2 sentences)
-- Something like "Good work. That's what I like to see." or "About time! But good job."
-- Then ask: "What's the next task?" or similar push to keep going
+def clear_history(user_id: int):
+    _histories.clear(user_id)
+    with _gemini_histories_lock:
+        # Empty rather than popped: a reload before the writer thread has
+        # deleted the saved turns would bring them back
+        _gemini_histories[user_id] = deque(maxlen=2 * CHAT_HISTORY_TURNS)
+        _gemini_histories.move_to_end(user_id)
 
-Don't write a motivational essay. Stay in character.
-""".strip()
-    return _call(prompt)
 
+# ─────────────────────────────────────────────
+# ASYNC WRAPPERS — for handlers and the scheduler
+# ─────────────────────────────────────────────
 
-def chat(user_id: int, message: str, pending_tasks: list = None) -> str:
-    """Multi-turn private chat conversation with boss personality."""
-    history = _histories.setdefault(user_id, [])
+async def _run(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_ai_executor, fn, *args)
 
-    # Format the DB context injection to guide the AI
-    tasks_context = "User has NO pending tasks."
-    if pending_tasks:
-        tasks_context = "User's current pending tasks:\n" + "\n".join([f"- {t['text']} ({t['category']})" for t in pending_tasks])
 
-    # Combine the actual message with hidden context for the AI
-    enhanced_message = f"[SYSTEM SECRET CONTEXT - DO NOT MENTION THIS PREFIX DIRECTLY]\n{tasks_context}\n[END CONTEXT]\n\nUser says: {message}"
+async def aclassify_task(task_text: str) -> dict:
+    return await _run(classify_task, task_text)
 
-    # Build new-SDK history format (only keeping last 3 turns)
-    gemini_history: list[types.Content] = []
-    for turn in history[-3:]:
-        gemini_history.append(types.Content(role="user", parts=[types.Part(text=turn["enhanced_message"])]))
-        gemini_history.append(types.Content(role="model", parts=[types.Part(text=turn["bot"])]))
 
-    reply = _chat_call(gemini_history, enhanced_message)
-    
-    # Save the injected prompt in history so it has context of past DB states too
-    history.append({"user": message, "enhanced_message": enhanced_message, "bot": reply})
+async def agenerate_reminder(task: TaskLike) -> str:
+    return await _run(generate_reminder, task)
 
-    # Keep memory extremely tight (max 3) since DB handles the heavy lifting
-    if len(history) > 3:
-        _histories[user_id] = history[-3:]
 
-    return reply
+async def agenerate_why_response(task: TaskLike, reason: str) -> str:
+    return await _run(generate_why_response, task, reason)
 
 
-def clear_history(user_id: int):
-    _histories.pop(user_id, None)
+_STREAM_END = object()
+
+
+async def agenerate_done_response_stream(task: TaskLike) -> AsyncIterator[str]:
+    # The whole stream is one executor job, so chunks don't each queue behind
+    # other AI calls; they're handed back to the loop as they arrive.
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+
+    def pump():
+        try:
+            for chunk in generate_done_response_stream(task):
+                loop.call_soon_threadsafe(queue.put_nowait, chunk)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        else:
+            loop.call_soon_threadsafe(queue.put_nowait, _STREAM_END)
+
+    job = loop.run_in_executor(_ai_executor, pump)
+    while (item := await queue.get()) is not _STREAM_END:
+        if isinstance(item, Exception):
+            raise item
+        yield item
+    await job
+
+
+async def achat(user_id: int, message: str, tasks_context: str = NO_TASKS_CONTEXT) -> str:
+    return await _run(chat, user_id, message, tasks_context)
+
+
+def shutdown():
+    """
+    Drop queued AI work and close the HTTP pool; safe to call more than once.
+    Called from main.py's post_shutdown: an atexit hook would run too late, as
+    concurrent.futures joins its workers (draining the queue) before atexit.
+    """
+    for pool in (_ai_executor, _hedge_pool):
+        pool.shutdown(wait=False, cancel_futures=True)
+    client.close()
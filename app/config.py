@@ -37,3 +37,8 @@ CATEGORY_TOPIC_MAP = {
 }
 
 REMINDER_INTERVAL_MINUTES = 60
+
+# SQLite file for private-chat history and the classify cache; survives
+# redeploys only on a mounted volume (docker-compose points it at the
+# chat_history volume)
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH") or "chat_history.db"
@@ -1,10 +1,38 @@
+import asyncio
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase
 from config import DATABASE_URL
 
-engine = create_async_engine(DATABASE_URL, echo=False)
+engine = create_async_engine(
+    DATABASE_URL,
+    echo=False,
+    pool_size=10,
+    max_overflow=20,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    connect_args={
+        # SQLAlchemy's asyncpg adapter keeps its own per-connection LRU of
+        # prepared statements (default 100); asyncpg's statement_cache_size
+        # is bypassed because SQLAlchemy prepares statements explicitly.
+        "prepared_statement_cache_size": 1024,
+        # Our queries are tiny OLTP lookups; JIT compilation only adds latency
+        "server_settings": {"jit": "off"},
+    },
+)
 SessionLocal = async_sessionmaker(engine, expire_on_commit=False)
 
 
 class Base(DeclarativeBase):
     pass
+
+
+async def warm_pool(size: int = 10):
+    """Open `size` pooled connections up front so early updates skip connect + type introspection."""
+    async def _ping():
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    async with asyncio.TaskGroup() as tg:
+        for _ in range(size):
+            tg.create_task(_ping())
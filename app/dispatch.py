@@ -0,0 +1,70 @@
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable
+from telegram import Update
+from telegram.ext import Application, ContextTypes
+
+logger = logging.getLogger(__name__)
+
+# A chat's consumer exits after this many idle seconds; the next submit starts a new one
+IDLE_TIMEOUT = 5 * 60
+# Seconds drain() waits for queued jobs; stays inside Docker's default 10s stop grace period
+DRAIN_TIMEOUT = 8
+
+_queues: dict[int, asyncio.Queue] = {}
+_consumers: set[asyncio.Task] = set()  # strong refs: the loop only keeps weak ones
+
+
+def submit(update: Update, context: ContextTypes.DEFAULT_TYPE, job: Callable[[], Awaitable]):
+    """
+    Run `job()` after every job already queued for this chat, without waiting for it.
+    Jobs within a chat stay in order; different chats run concurrently. A failing
+    job goes to the application's error handlers with `update`, like a handler error.
+    """
+    chat_id = update.effective_chat.id
+    queue = _queues.get(chat_id)
+    if queue is None:
+        queue = _queues[chat_id] = asyncio.Queue()
+        consumer = asyncio.create_task(
+            _consume(context.application, chat_id, queue), name=f"chat-{chat_id}"
+        )
+        _consumers.add(consumer)
+        consumer.add_done_callback(_consumers.discard)
+    queue.put_nowait((update, job))
+
+
+async def _consume(application: Application, chat_id: int, queue: asyncio.Queue):
+    while True:
+        try:
+            update, job = await asyncio.wait_for(queue.get(), IDLE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # No await between the check and the pop, so no submit can slip in
+            if queue.empty():
+                _queues.pop(chat_id, None)
+                return
+            continue
+        try:
+            await job()
+        except Exception as e:
+            logger.exception(f"Queued job for chat {chat_id} failed")
+            await application.process_error(update, e)
+        finally:
+            queue.task_done()
+
+
+async def drain():
+    """Finish queued jobs (up to DRAIN_TIMEOUT) and stop the consumers.
+
+    Called from main.py's post_stop: updates have stopped arriving but the bot
+    can still send, so queued replies aren't dropped on a redeploy.
+    """
+    pending = [queue.join() for queue in _queues.values()]
+    if pending:
+        try:
+            await asyncio.wait_for(asyncio.gather(*pending), DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Dropping queued jobs still running after {DRAIN_TIMEOUT}s")
+    for consumer in list(_consumers):
+        consumer.cancel()
+    await asyncio.gather(*_consumers, return_exceptions=True)
+    _queues.clear()
@@ -1,15 +1,87 @@
 import asyncio
 import logging
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from collections.abc import AsyncIterator
+from telegram import Update
 from telegram.ext import ContextTypes
-from sqlalchemy import select
+from sqlalchemy import Integer, bindparam, func
+from sqlalchemy import update as sa_update  # handlers take a parameter named `update`
 
 from database import SessionLocal
 from models import Task
-from ai import generate_done_response, generate_why_response
+from pending import pop_pending, set_pending
+from ai import agenerate_done_response_stream, agenerate_why_response
 
 logger = logging.getLogger(__name__)
 
+_TASK_ID = Task.id == bindparam("tid", type_=Integer)
+_MARK_DONE = sa_update(Task).where(_TASK_ID).values(status="done").returning(Task.text, Task.category)
+_MARK_DOING = sa_update(Task).where(_TASK_ID).values(reminded_at=func.now()).returning(Task.id)
+# NOTE: overdue_count is ONLY incremented by the scheduler, not here
+# This avoids the double-increment bug
+_SET_REASON = (
+    sa_update(Task)
+    .where(_TASK_ID)
+    .values(snooze_reason=bindparam("reason"))
+    .returning(Task.text, Task.category, Task.overdue_count)
+)
+
+# Streamed replies land in group topics, where main.py's AIORateLimiter allows
+# only 20 requests per chat per minute (its group default). Each partial edit
+# spends one, alongside the ack and final edit, so keep them few and spaced out.
+STREAM_EDIT_INTERVAL = 3.0
+MAX_STREAM_EDITS = 2
+
+
+async def _stream_reply(query, chunks: AsyncIterator[str], header: str) -> str:
+    """Edit the message as AI chunks arrive; returns the full reply text."""
+    loop = asyncio.get_running_loop()
+    text = ""
+    last_edit = loop.time()
+    edits = 0
+    async for chunk in chunks:
+        text += chunk
+        if edits < MAX_STREAM_EDITS and loop.time() - last_edit >= STREAM_EDIT_INTERVAL:
+            last_edit = loop.time()
+            edits += 1
+            try:
+                # Plain text: half-streamed Markdown may not parse yet
+                await query.edit_message_text(f"{header}\n\n{text} ⏳")
+            except Exception as e:
+                logger.warning(f"Streamed edit failed: {e}")
+    return text.strip()
+
+
+async def _finish_done(query, task_id: int):
+    """Mark the task done and stream the AI reply; runs off the update worker."""
+    try:
+        # Single round trip: mark done and read back what the AI reply needs
+        async with SessionLocal() as session, session.begin():
+            result = await session.execute(_MARK_DONE, {"tid": task_id})
+            task = result.one_or_none()
+
+        if not task:
+            await query.edit_message_text("❌ Vazifa topilmadi.")
+            return
+
+        # Ack immediately; the AI reply replaces this once it arrives
+        await query.edit_message_text("✅ *Bajarildi!* ⏳", parse_mode="Markdown")
+
+        try:
+            reply = await _stream_reply(
+                query,
+                agenerate_done_response_stream(task),
+                "✅ Bajarildi!",
+            )
+        except Exception as e:
+            logger.error(f"AI done response failed: {e}")
+            reply = ""
+
+        reply = reply or "Yaxshi, bajarildi! ✅"
+        await query.edit_message_text(f"✅ *Bajarildi!*\n\n{reply}", parse_mode="Markdown")
+        logger.info(f"Task #{task_id} marked as done")
+    except Exception as e:
+        logger.error(f"Failed to finish done for task #{task_id}: {e}")
+
 
 async def button_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -21,74 +93,72 @@ async def button_callback_handler(update: Update, context: ContextTypes.DEFAULT_
 
     logger.info(f"Button callback: action={action}, task_id={task_id}")
 
-    async with SessionLocal() as session:
-        result = await session.execute(select(Task).where(Task.id == task_id))
-        task = result.scalar_one_or_none()
+    if action == "done":
+        # The AI reply takes seconds; don't hold the update worker for it
+        context.application.create_task(_finish_done(query, task_id), update=update)
+        return
 
-        if not task:
+    if action == "doing_now":
+        # Give them a temporary grace period on reminders by resetting reminded_at
+        async with SessionLocal() as session, session.begin():
+            result = await session.execute(_MARK_DOING, {"tid": task_id})
+            found = result.scalar_one_or_none()
+
+        if found is None:
             await query.edit_message_text("❌ Vazifa topilmadi.")
             return
 
-        if action == "done":
-            task.status = "done"
-            await session.commit()
+        await query.edit_message_text("⏳ Yaxshi, kutaman. Diqqat bilan ishla! 💪")
+        logger.info(f"Task #{task_id} marked as doing_now")
+        return
 
-            try:
-                reply = await asyncio.to_thread(
-                    generate_done_response,
-                    {"text": task.text, "category": task.category}
-                )
-            except Exception as e:
-                logger.error(f"AI done response failed: {e}")
-                reply = "Yaxshi, bajarildi! ✅"
+    async with SessionLocal() as session:
+        task = await session.get(Task, task_id)
 
-            await query.edit_message_text(f"✅ *Bajarildi!*\n\n{reply}", parse_mode="Markdown")
-            logger.info(f"Task #{task_id} marked as done")
+    if not task:
+        await query.edit_message_text("❌ Vazifa topilmadi.")
+        return
 
-        elif action == "notyet":
-            # Ask for reason
-            context.user_data[f"awaiting_reason_{task_id}"] = True
-            await query.edit_message_text(
-                "❌ Nima uchun bajarilmadi? Sababini yozing:",
-            )
-            context.user_data["pending_notyet_task_id"] = task_id
-            logger.info(f"Task #{task_id}: awaiting reason from user")
+    if action == "notyet":
+        # Ask for reason
+        await query.edit_message_text(
+            "❌ Nima uchun bajarilmadi? Sababini yozing:",
+        )
+        set_pending(query.from_user.id, task_id)
+        logger.info(f"Task #{task_id}: awaiting reason from user")
+
+
+async def _finish_reason(message, task_id: int, reason: str):
+    """Store the snooze reason and reply with the AI's take; runs off the update worker."""
+    try:
+        async with SessionLocal() as session, session.begin():
+            result = await session.execute(_SET_REASON, {"tid": task_id, "reason": reason})
+            task = result.one_or_none()
+
+        if not task:
+            return
 
-        elif action == "doing_now":
-            from sqlalchemy import func
-            # Give them a temporary grace period on reminders by resetting reminded_at
-            task.reminded_at = func.now()
-            await session.commit()
-            await query.edit_message_text("⏳ Yaxshi, kutaman. Diqqat bilan ishla! 💪")
-            logger.info(f"Task #{task_id} marked as doing_now")
+        # Ack immediately; the AI reply replaces this once it arrives
+        interim = await message.reply_text("⏳")
+
+        try:
+            reply = await agenerate_why_response(task, reason)
+        except Exception as e:
+            logger.error(f"AI why response failed: {e}")
+            reply = "Bahona qilma, ishni qil! 💪"
+
+        await interim.edit_text(reply)
+    except Exception as e:
+        logger.error(f"Failed to handle reason for task #{task_id}: {e}")
 
 
 async def reason_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles user's text reply after pressing ❌ Not yet."""
-    task_id = context.user_data.get("pending_notyet_task_id")
+    task_id = pop_pending(update.effective_user.id)
     if not task_id:
         return
 
     reason = update.message.text
     logger.info(f"Received reason for task #{task_id}: {reason[:50]}...")
 
-    async with SessionLocal() as session:
-        result = await session.execute(select(Task).where(Task.id == task_id))
-        task = result.scalar_one_or_none()
-        if not task:
-            return
-        task.snooze_reason = reason
-        # NOTE: overdue_count is ONLY incremented by the scheduler, not here
-        # This avoids the double-increment bug
-        await session.commit()
-        task_dict = {"text": task.text, "category": task.category, "overdue_count": task.overdue_count}
-
-    try:
-        reply = await asyncio.to_thread(generate_why_response, task_dict, reason)
-    except Exception as e:
-        logger.error(f"AI why response failed: {e}")
-        reply = "Bahona qilma, ishni qil! 💪"
-
-    await update.message.reply_text(reply)
-    context.user_data.pop("pending_notyet_task_id", None)
-    context.user_data.pop(f"awaiting_reason_{task_id}", None)
+    context.application.create_task(_finish_reason(update.message, task_id, reason), update=update)
@@ -1,26 +1,32 @@
-import asyncio
 import logging
-from datetime import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from datetime import datetime, timezone
+from telegram import Update
 from telegram.ext import ContextTypes
 
 from config import OWNER_ID, TOPIC_GENERAL, CATEGORY_TOPIC_MAP
 from database import SessionLocal
 from models import Task
-from ai import classify_task
+from keyboards import task_keyboard
+from dispatch import submit
+from ai import aclassify_task
 
 logger = logging.getLogger(__name__)
 
+_CATEGORY_EMOJI = {"work": "💼", "personal": "🙋", "health": "💪", "other": "📌"}
+_TASK_MESSAGE = "{emoji} *{title}*\n\n📝 {text}{due}\n\n🆔 Task #{task_id}"
+_DUE_LINE = "\n📅 Muddat: {:%d.%m.%Y %H:%M}"
+_CONFIRM_MESSAGE = (
+    "✅ Vazifa qabul qilindi!\n"
+    "📂 Kategoriya: *{category}*\n"
+    "📨 #{category} mavzusiga joylashtirildi."
+)
+
 
 async def group_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message
     if not message or not message.text:
         return
 
-    # Only process messages from owner
-    if message.from_user.id != OWNER_ID:
-        return
-
     # Topic filtering: if TOPIC_GENERAL is configured, only process messages from that topic
     # If TOPIC_GENERAL is 0 (not set), accept all messages from the owner in the group
     if TOPIC_GENERAL and message.message_thread_id != TOPIC_GENERAL:
@@ -30,14 +36,20 @@ async def group_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
     if message.entities and any(e.type == "bot_command" for e in message.entities):
         return
 
+    # Classification takes a Gemini round trip; queue it so other chats aren't blocked
+    submit(update, context, lambda: _save_and_route(message, context))
+
+
+async def _save_and_route(message, context: ContextTypes.DEFAULT_TYPE):
+    """Classify the task, save it and post it to its category topic."""
     task_text = message.text
     group_id = message.chat_id
 
     logger.info(f"Processing task from owner in group {group_id}: {task_text[:50]}...")
 
-    # Classify with AI (async to not block event loop)
+    # Classify with AI (runs on the AI executor, not the event loop)
     try:
-        classification = await asyncio.to_thread(classify_task, task_text)
+        classification = await aclassify_task(task_text)
     except Exception as e:
         logger.error(f"AI classification failed: {e}")
         await message.reply_text("⚠️ AI bilan bog'lanishda xatolik. Qaytadan urinib ko'ring.")
@@ -58,13 +70,16 @@ async def group_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
                 due_at = datetime.strptime(due_hint, "%Y-%m-%d")
             except ValueError:
                 pass
+    if due_at:
+        # Deadlines are interpreted as UTC, same as the scheduler's clock
+        due_at = due_at.replace(tzinfo=timezone.utc)
 
     # Get destination topic ID
     destination_topic = CATEGORY_TOPIC_MAP.get(category, CATEGORY_TOPIC_MAP["other"])
 
-    # Save to database
+    # Save to database: flush reads the new id back via RETURNING, commit on exit
     try:
-        async with SessionLocal() as session:
+        async with SessionLocal() as session, session.begin():
             task = Task(
                 text=task_text,
                 category=category,
@@ -75,8 +90,7 @@ async def group_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
                 due_at=due_at,
             )
             session.add(task)
-            await session.commit()
-            await session.refresh(task)
+            await session.flush()
             task_id = task.id
     except Exception as e:
         logger.error(f"Database error saving task: {e}")
@@ -86,24 +100,15 @@ async def group_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
     logger.info(f"Task #{task_id} saved: category={category}, topic={destination_topic}")
 
     # Post task into correct topic (or same chat if topics not configured)
-    category_emoji = {"work": "💼", "personal": "🙋", "health": "💪", "other": "📌"}
-    emoji = category_emoji.get(category, "📌")
-
-    due_text = f"\n📅 Muddat: {due_at.strftime('%d.%m.%Y %H:%M')}" if due_at else ""
-    task_message = (
-        f"{emoji} *{short_title}*\n\n"
-        f"📝 {task_text}"
-        f"{due_text}\n\n"
-        f"🆔 Task #{task_id}"
+    task_message = _TASK_MESSAGE.format(
+        emoji=_CATEGORY_EMOJI.get(category, "📌"),
+        title=short_title,
+        text=task_text,
+        due=_DUE_LINE.format(due_at) if due_at else "",
+        task_id=task_id,
     )
 
-    keyboard = InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("✅ Bajarildi", callback_data=f"done:{task_id}"),
-            InlineKeyboardButton("❌", callback_data=f"notyet:{task_id}"),
-            InlineKeyboardButton("⏳ Hozir qilyapman", callback_data=f"doing_now:{task_id}"),
-        ]
-    ])
+    keyboard = task_keyboard(task_id)
 
     try:
         if destination_topic:
@@ -133,8 +138,6 @@ async def group_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
 
     # Confirm in #general (or same chat)
     await message.reply_text(
-        f"✅ Vazifa qabul qilindi!\n"
-        f"📂 Kategoriya: *{category}*\n"
-        f"📨 #{category} mavzusiga joylashtirildi.",
+        _CONFIRM_MESSAGE.format(category=category),
         parse_mode="Markdown"
     )
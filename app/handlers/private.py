@@ -1,26 +1,37 @@
-import asyncio
 import logging
 from telegram import Update
 from telegram.ext import ContextTypes
-from sqlalchemy import select
+from sqlalchemy import Integer, BigInteger, bindparam, select
 
-from config import OWNER_ID
-from ai import chat, clear_history
+from ai import NO_TASKS_CONTEXT, achat, clear_history
 from database import SessionLocal
 from models import Task
+from dispatch import submit
 
 logger = logging.getLogger(__name__)
 
+CONTEXT_TASK_LIMIT = 5
+
+# Newest pending tasks, injected into the chat prompt as DB context
+_SELECT_PENDING = (
+    select(Task.text, Task.category)
+    .where(Task.owner_id == bindparam("owner_id", type_=BigInteger))
+    .where(Task.status == "pending")
+    .order_by(Task.created_at.desc())
+    .limit(bindparam("lim", type_=Integer))
+)
+
 
 async def private_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message
     if not message or not message.text:
         return
-    if message.from_user.id != OWNER_ID:
-        return
-    if message.chat.type != "private":
-        return
 
+    # Queued per chat: replies stay in order and don't block other chats
+    submit(update, context, lambda: _reply(message))
+
+
+async def _reply(message):
     user_id = message.from_user.id
     user_text = message.text
 
@@ -31,24 +42,23 @@ async def private_message_handler(update: Update, context: ContextTypes.DEFAULT_
 
     logger.info(f"Private chat from {user_id}: {user_text[:50]}...")
 
-    # DB Context Injection: Fetch active tasks
-    pending_tasks = []
+    # DB Context Injection: Fetch active tasks and format them for the AI
+    tasks_context = NO_TASKS_CONTEXT
     try:
         async with SessionLocal() as session:
             result = await session.execute(
-                select(Task)
-                .where(Task.owner_id == user_id)
-                .where(Task.status == "pending")
-                .order_by(Task.created_at.desc())
-                .limit(5)
+                _SELECT_PENDING, {"owner_id": user_id, "lim": CONTEXT_TASK_LIMIT}
             )
-            tasks = result.scalars().all()
-            pending_tasks = [{"text": t.text, "category": t.category} for t in tasks]
+            tasks = result.all()
+            if tasks:
+                tasks_context = "User's current pending tasks:\n" + "\n".join(
+                    f"- {t.text} ({t.category})" for t in tasks
+                )
     except Exception as e:
         logger.error(f"Failed to fetch tasks for DB context: {e}")
 
     try:
-        reply = await asyncio.to_thread(chat, user_id, user_text, pending_tasks)
+        reply = await achat(user_id, user_text, tasks_context)
     except Exception as e:
         logger.error(f"AI chat failed: {e}")
         reply = "⚠️ AI bilan bog'lanishda xatolik. Qaytadan urinib ko'ring."
@@ -0,0 +1,146 @@
+import atexit
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# (user message, message as sent to the AI with DB context, bot reply)
+Turn = tuple[str, str, str]
+
+
+class _SqliteStore:
+    """
+    A table in a SQLite file (WAL) whose writes go behind through a daemon
+    thread on its own connection; subclasses implement _write() for one item.
+    """
+
+    def __init__(self, path: str, schema: str, writer_name: str):
+        self._path = path
+        self._lock = threading.Lock()  # guards self._conn across executor threads
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(schema)
+        self._conn.commit()
+
+        self._writes: queue.Queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name=writer_name, daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def close(self):
+        """Flush pending writes; registered with atexit."""
+        if self._writer.is_alive():
+            self._writes.put(None)
+            self._writer.join(timeout=5)
+
+    def _write(self, conn: sqlite3.Connection, item: tuple):
+        raise NotImplementedError
+
+    def _write_loop(self):
+        # Separate connection: sqlite3 connections must not be shared mid-statement
+        conn = sqlite3.connect(self._path)
+        while True:
+            item = self._writes.get()
+            if item is None:
+                break
+            try:
+                self._write(conn, item)
+                conn.commit()
+            except Exception as e:
+                logger.error(f"{self._writer.name} failed to persist to {self._path}: {e}")
+        conn.close()
+
+
+class HistoryStore(_SqliteStore):
+    """
+    Last few private-chat turns per user, persisted to SQLite (WAL).
+
+    Writes go behind through a daemon thread; reads only happen when ai.py
+    seeds its in-memory history for a user, so this holds no copy of its own.
+    """
+
+    def __init__(self, path: str, turns: int = 3):
+        self.turns = turns
+        super().__init__(
+            path,
+            "CREATE TABLE IF NOT EXISTS chat_history ("
+            "user_id INTEGER, idx INTEGER, u TEXT, e TEXT, b TEXT, "
+            "PRIMARY KEY (user_id, idx))",
+            "history-writer",
+        )
+
+    def load(self, user_id: int) -> list[Turn]:
+        """The user's saved turns, oldest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT u, e, b FROM chat_history WHERE user_id = ? ORDER BY idx DESC LIMIT ?",
+                (user_id, self.turns),
+            ).fetchall()
+        return rows[::-1]
+
+    def append(self, user_id: int, turn: Turn):
+        self._writes.put(("append", user_id, turn))
+
+    def clear(self, user_id: int):
+        self._writes.put(("clear", user_id, None))
+
+    def _write(self, conn: sqlite3.Connection, item: tuple):
+        op, user_id, turn = item
+        if op == "append":
+            conn.execute(
+                "INSERT INTO chat_history (user_id, idx, u, e, b) VALUES (?, ?, ?, ?, ?)",
+                (user_id, time.time_ns(), *turn),
+            )
+            conn.execute(
+                "DELETE FROM chat_history WHERE user_id = ? AND idx NOT IN "
+                "(SELECT idx FROM chat_history WHERE user_id = ? ORDER BY idx DESC LIMIT ?)",
+                (user_id, user_id, self.turns),
+            )
+        else:
+            conn.execute("DELETE FROM chat_history WHERE user_id = ?", (user_id,))
+
+
+class ClassifyStore(_SqliteStore):
+    """
+    classify_task results persisted to SQLite (WAL), so the cache survives redeploys.
+
+    ai.py reads everything still fresh once at import and serves from memory;
+    after that this only writes behind, trimmed to the same size and TTL.
+    """
+
+    def __init__(self, path: str, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        super().__init__(
+            path,
+            "CREATE TABLE IF NOT EXISTS classify_cache ("
+            "key BLOB PRIMARY KEY, stored_at REAL, data BLOB)",
+            "classify-writer",
+        )
+
+    def load(self) -> list[tuple[bytes, float, bytes]]:
+        """(key, stored_at, JSON) for entries younger than ttl, oldest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, stored_at, data FROM classify_cache WHERE stored_at > ? "
+                "ORDER BY stored_at DESC LIMIT ?",
+                (time.time() - self.ttl, self.size),
+            ).fetchall()
+        return rows[::-1]
+
+    def put(self, key: bytes, stored_at: float, data: bytes):
+        """stored_at is wall-clock time.time(), so it stays valid across restarts."""
+        self._writes.put((key, stored_at, data))
+
+    def _write(self, conn: sqlite3.Connection, item: tuple):
+        conn.execute("INSERT OR REPLACE INTO classify_cache (key, stored_at, data) VALUES (?, ?, ?)", item)
+        conn.execute("DELETE FROM classify_cache WHERE stored_at <= ?", (time.time() - self.ttl,))
+        conn.execute(
+            "DELETE FROM classify_cache WHERE key NOT IN "
+            "(SELECT key FROM classify_cache ORDER BY stored_at DESC LIMIT ?)",
+            (self.size,),
+        )
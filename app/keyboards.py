@@ -0,0 +1,19 @@
+from functools import lru_cache
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+# (label, callback action) for the buttons under every task message;
+# actions must match the CallbackQueryHandler pattern in main.py
+_KB_TASK_BUTTONS = (
+    ("✅ Bajarildi", "done"),
+    ("❌", "notyet"),
+    ("⏳ Hozir qilyapman", "doing_now"),
+)
+
+
+@lru_cache(maxsize=1024)
+def task_keyboard(task_id: int) -> InlineKeyboardMarkup:
+    """✅/❌/⏳ buttons for a task. PTB markups are immutable, so reuse is safe."""
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(label, callback_data=f"{action}:{task_id}")
+        for label, action in _KB_TASK_BUTTONS
+    ]])
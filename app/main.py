@@ -2,6 +2,7 @@ import logging
 import traceback
 from telegram import Update
 from telegram.ext import (
+    AIORateLimiter,
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
@@ -9,7 +10,10 @@ from telegram.ext import (
     filters,
 )
 
-from config import BOT_TOKEN
+from config import BOT_TOKEN, OWNER_ID
+from database import warm_pool
+from dispatch import drain
+from ai import shutdown as shutdown_ai
 from handlers.start import start_handler
 from handlers.topics import topics_handler
 from handlers.group import group_message_handler
@@ -41,8 +45,33 @@ async def error_handler(update: object, context) -> None:
             pass
 
 
+async def post_init(app) -> None:
+    try:
+        await warm_pool()
+    except Exception as e:
+        logger.warning(f"DB pool warm-up failed: {e}")
+
+
+async def post_stop(app) -> None:
+    await drain()
+
+
+async def post_shutdown(app) -> None:
+    shutdown_ai()
+
+
 def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        # Paces every Bot API call under Telegram's ~30 msg/s cap; on a
+        # RetryAfter it waits as told and retries once
+        .rate_limiter(AIORateLimiter(overall_max_rate=25, overall_time_period=1, max_retries=1))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Commands
     app.add_handler(CommandHandler("start", start_handler))
@@ -51,9 +80,12 @@ def main():
     # Inline button callbacks
     app.add_handler(CallbackQueryHandler(button_callback_handler, pattern="^(done|notyet|doing_now):"))
 
+    # Only the owner's messages reach the group and chat handlers
+    owner = filters.User(user_id=OWNER_ID)
+
     # Group messages (reads #general topic)
     app.add_handler(MessageHandler(
-        (filters.ChatType.GROUP | filters.ChatType.SUPERGROUP) & filters.TEXT & ~filters.COMMAND,
+        owner & (filters.ChatType.GROUP | filters.ChatType.SUPERGROUP) & filters.TEXT & ~filters.COMMAND,
         group_message_handler
     ))
 
@@ -65,7 +97,7 @@ def main():
 
     # Private chat: general AI conversation
     app.add_handler(MessageHandler(
-        filters.ChatType.PRIVATE & filters.TEXT & ~filters.COMMAND,
+        owner & filters.ChatType.PRIVATE & filters.TEXT & ~filters.COMMAND,
         private_message_handler,
     ), group=2)
 
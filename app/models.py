@@ -1,11 +1,19 @@
 from datetime import datetime
-from sqlalchemy import BigInteger, Integer, Text, String, DateTime, func
+from sqlalchemy import BigInteger, Integer, Text, String, DateTime, Index, func
 from sqlalchemy.orm import Mapped, mapped_column
 from database import Base
 
 
 class Task(Base):
     __tablename__ = "tasks"
+    __table_args__ = (
+        # The scheduler's every-minute reminder query filters on these
+        Index("ix_tasks_status_due", "status", "due_at"),
+        Index("ix_tasks_status_reminded", "status", "reminded_at"),
+        # Private chat's "newest pending tasks" context; ORDER BY created_at DESC
+        # walks this backwards, so no DESC column is needed
+        Index("ix_tasks_owner_status_created", "owner_id", "status", "created_at"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     text: Mapped[str] = mapped_column(Text, nullable=False)
@@ -16,12 +24,12 @@ class Task(Base):
     topic_id: Mapped[int] = mapped_column(Integer, nullable=True)
     owner_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
 
-    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
-    due_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
-    reminded_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    due_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=True)
+    reminded_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=True)
     overdue_count: Mapped[int] = mapped_column(Integer, default=0)
     snooze_reason: Mapped[str] = mapped_column(Text, nullable=True)
     
     # Precision reminder tracking tracking
     reminded_before_due: Mapped[bool] = mapped_column(default=False)
-    deadline_asked_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    deadline_asked_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=True)
@@ -0,0 +1,22 @@
+import time
+
+# How long a ❌ press waits for its reason message
+PENDING_TTL = 10 * 60  # seconds
+
+# user_id -> (expires_at, task_id) for the task whose snooze reason we're waiting on
+_pending: dict[int, tuple[float, int]] = {}
+
+
+def set_pending(user_id: int, task_id: int):
+    now = time.monotonic()
+    for uid in [uid for uid, (expires_at, _) in _pending.items() if expires_at <= now]:
+        del _pending[uid]
+    _pending[user_id] = (now + PENDING_TTL, task_id)
+
+
+def pop_pending(user_id: int) -> int | None:
+    """Task id awaiting a reason from this user, if any and not expired; clears it."""
+    entry = _pending.pop(user_id, None)
+    if entry is None or entry[0] <= time.monotonic():
+        return None
+    return entry[1]
@@ -1,115 +1,176 @@
 import asyncio
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from sqlalchemy import select
-from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+from collections import defaultdict
+from sqlalchemy import Row, and_, bindparam, case, func, or_, select, update
+from telegram import Bot
 
 from database import SessionLocal
 from models import Task
-from ai import generate_reminder
+from keyboards import task_keyboard
+from ai import AI_WORKERS, agenerate_reminder, classify_cache_stats
 
 logger = logging.getLogger(__name__)
 
-
-async def send_reminders(bot: Bot):
-    """Check all pending tasks and send reminders if needed."""
-    now = datetime.utcnow()
-
-    async with SessionLocal() as session:
-        result = await session.execute(
-            select(Task).where(Task.status == "pending")
-        )
-        tasks = result.scalars().all()
-
-    for task in tasks:
-        should_remind = False
-        update_flag = None
-
-        if task.due_at:
-            # 1. Check 1 hour before deadline
-            one_hour_before = task.due_at - timedelta(hours=1)
-            if now >= one_hour_before and now < task.due_at and not task.reminded_before_due:
-                should_remind = True
-                update_flag = "reminded_before_due"
-
-            # 2. Check exactly at deadline
-            elif now >= task.due_at and not task.deadline_asked_at:
-                should_remind = True
-                update_flag = "deadline_asked_at"
-
-            # 3. Check 30 minutes overdue penalty
-            elif task.deadline_asked_at and now >= task.deadline_asked_at + timedelta(minutes=30):
-                should_remind = True
-                update_flag = "overdue_penalty"
-        else:
-            # No due date: remind every 48 hours
-            last = task.reminded_at or task.created_at
-            if now >= last + timedelta(hours=48):
-                should_remind = True
-                update_flag = "standard_48h"
-
-        if not should_remind:
-            continue
-
-        task_dict = {
-            "text": task.text,
-            "category": task.category,
-            "overdue_count": task.overdue_count,
-        }
-
-        # Async AI call to prevent blocking the event loop
+# Per-tick concurrency caps: Gemini calls in flight, Telegram sends in flight
+AI_CONCURRENCY = AI_WORKERS
+SEND_CONCURRENCY = 30
+# Due rows fetched per page; each page is reminded with no DB connection held
+STREAM_BATCH = 200
+
+# Prepended to the AI reminder for the deadline alerts
+_REMINDER_PREFIX = {
+    "deadline_asked_at": "⏰ Muddat keldi!\n\n",
+    "reminded_before_due": "1 soat qoldi! ",
+}
+_FALLBACK_REMINDER = "⏰ Hali bajarilmagan vazifa bor: {}"
+
+
+# Hot statements are built once; per-tick times are bound via _tick_params()
+_NOW = bindparam("now")
+_HOUR_AHEAD = bindparam("hour_ahead")
+_HALF_HOUR_AGO = bindparam("half_hour_ago")
+_TWO_DAYS_AGO = bindparam("two_days_ago")
+
+_has_due = Task.due_at.is_not(None)
+# (condition, update_flag) pairs, checked in order like an if/elif chain
+_REMINDER_RULES = [
+    # 1. Check 1 hour before deadline
+    (and_(_has_due, Task.due_at <= _HOUR_AHEAD, Task.due_at > _NOW,
+          Task.reminded_before_due.is_(False)), "reminded_before_due"),
+    # 2. Check exactly at deadline
+    (and_(_has_due, Task.due_at <= _NOW, Task.deadline_asked_at.is_(None)), "deadline_asked_at"),
+    # 3. Check 30 minutes overdue penalty
+    (and_(_has_due, Task.deadline_asked_at <= _HALF_HOUR_AGO), "overdue_penalty"),
+    # No due date: remind every 48 hours
+    (and_(Task.due_at.is_(None),
+          func.coalesce(Task.reminded_at, Task.created_at) <= _TWO_DAYS_AGO), "standard_48h"),
+]
+# Plain rows with just what a reminder needs: no ORM identity map or hydration
+_SELECT_DUE = (
+    select(
+        Task.id, Task.text, Task.category, Task.overdue_count, Task.group_id, Task.topic_id,
+        case(*_REMINDER_RULES).label("update_flag"),
+    )
+    .where(Task.status == "pending", or_(*(cond for cond, _ in _REMINDER_RULES)))
+    # Keyset paging by id: the read finishes before the slow AI calls and sends
+    .where(Task.id > bindparam("after_id"))
+    .order_by(Task.id)
+    .limit(STREAM_BATCH)
+)
+
+# Tracker columns recording which alert was sent, one UPDATE per update_flag
+_TRACKER_VALUES = {
+    "reminded_before_due": {"reminded_before_due": True},
+    "deadline_asked_at": {"deadline_asked_at": _NOW},
+    # Reset deadline_asked_at so it falls into standard 48h loop
+    "overdue_penalty": {"overdue_count": Task.overdue_count + 1, "deadline_asked_at": None},
+    "standard_48h": {"overdue_count": Task.overdue_count + 1},
+}
+_MARK_SENT = {
+    flag: update(Task)
+    .where(Task.id.in_(bindparam("ids", expanding=True)))
+    .values(reminded_at=_NOW, **values)
+    .execution_options(synchronize_session=False)
+    for flag, values in _TRACKER_VALUES.items()
+}
+
+
+def _tick_params(now: datetime) -> dict:
+    return {
+        "now": now,
+        "hour_ahead": now + timedelta(hours=1),
+        "half_hour_ago": now - timedelta(minutes=30),
+        "two_days_ago": now - timedelta(hours=48),
+    }
+
+
+async def _prepare_one(task: Row, sem: asyncio.Semaphore) -> str:
+    """Reminder text for one task; falls back to a plain nudge if the AI call fails."""
+    async with sem:
         try:
-            reminder_text = await asyncio.to_thread(generate_reminder, task_dict)
-            if update_flag == "deadline_asked_at":
-                reminder_text = f"⏰ Muddat keldi!\n\n{reminder_text}"
-            elif update_flag == "reminded_before_due":
-                reminder_text = f"1 soat qoldi! {reminder_text}"
+            reminder_text = await agenerate_reminder(task)
         except Exception as e:
             logger.error(f"AI reminder generation failed for task {task.id}: {e}")
-            reminder_text = f"⏰ Hali bajarilmagan vazifa bor: {task.text}"
+            return _FALLBACK_REMINDER.format(task.text)
 
-        keyboard = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton("✅ Bajarildi", callback_data=f"done:{task.id}"),
-                InlineKeyboardButton("❌", callback_data=f"notyet:{task.id}"),
-                InlineKeyboardButton("⏳ Hozir qilyapman", callback_data=f"doing_now:{task.id}"),
-            ]
-        ])
+    return _REMINDER_PREFIX.get(task.update_flag, "") + reminder_text
 
+
+async def _send_one(bot: Bot, task: Row, reminder_text: str, sem: asyncio.Semaphore) -> bool:
+    async with sem:
         try:
             send_kwargs = {
                 "chat_id": task.group_id,
                 "text": reminder_text,
-                "reply_markup": keyboard,
+                "reply_markup": task_keyboard(task.id),
             }
             # Only pass message_thread_id if topics are configured
             if task.topic_id:
                 send_kwargs["message_thread_id"] = task.topic_id
 
             await bot.send_message(**send_kwargs)
-
-            # Update DB trackers based on what triggered the alert
-            async with SessionLocal() as session:
-                result = await session.execute(select(Task).where(Task.id == task.id))
-                t = result.scalar_one_or_none()
-                if t:
-                    t.reminded_at = now
-                    
-                    if update_flag == "reminded_before_due":
-                        t.reminded_before_due = True
-                    elif update_flag == "deadline_asked_at":
-                        t.deadline_asked_at = now
-                    elif update_flag == "overdue_penalty":
-                        t.overdue_count += 1
-                        t.deadline_asked_at = None  # Reset so it falls into standard 48h loop
-                    elif update_flag == "standard_48h":
-                        t.overdue_count += 1
-                        
-                    await session.commit()
-
+            return True
         except Exception as e:
             logger.error(f"Failed to send reminder for task {task.id}: {e}")
+            return False
+
+
+async def _remind_batch(bot: Bot, due: list[Row], ai_sem: asyncio.Semaphore,
+                        send_sem: asyncio.Semaphore) -> list[bool]:
+    """Generate and send reminders for one batch; returns which sends succeeded."""
+    # All AI calls run concurrently, capped so one tick can't drain the Gemini quota
+    texts = await asyncio.gather(*(_prepare_one(task, ai_sem) for task in due))
+    return await asyncio.gather(*(
+        _send_one(bot, task, text, send_sem) for task, text in zip(due, texts)
+    ))
+
+
+async def send_reminders(bot: Bot):
+    """Send reminders for pending tasks that need one; the filtering happens in SQL."""
+    now = datetime.now(timezone.utc)
+    ai_sem = asyncio.Semaphore(AI_CONCURRENCY)
+    send_sem = asyncio.Semaphore(SEND_CONCURRENCY)
+    params = _tick_params(now)
+
+    try:
+        after_id = 0
+        while True:
+            async with SessionLocal() as session:
+                result = await session.execute(_SELECT_DUE, {**params, "after_id": after_id})
+                due = result.all()
+            if not due:
+                break
+
+            sent = await _remind_batch(bot, due, ai_sem, send_sem)
+            buckets = defaultdict(list)
+            for task, ok in zip(due, sent):
+                if ok:
+                    buckets[task.update_flag].append(task.id)
+
+            # Update DB trackers based on what triggered the alert: one UPDATE per
+            # flag, committed per page so delivered reminders aren't re-sent if a
+            # later page fails
+            if buckets:
+                async with SessionLocal() as session, session.begin():
+                    for flag, ids in buckets.items():
+                        await session.execute(_MARK_SENT[flag], {"ids": ids, "now": now})
+
+            if len(due) < STREAM_BATCH:
+                break
+            after_id = due[-1].id
+    except Exception as e:
+        logger.error(f"Reminder tick failed: {e}")
+
+
+def log_cache_stats():
+    stats = classify_cache_stats()
+    lookups = stats["hits"] + stats["misses"]
+    hit_rate = stats["hits"] / lookups if lookups else 0.0
+    logger.info(
+        f"Classify cache: {stats['hits']}/{lookups} hits ({hit_rate:.0%}), {stats['size']} entries"
+    )
 
 
 def start_scheduler(bot: Bot) -> AsyncIOScheduler:
@@ -122,6 +183,13 @@ def start_scheduler(bot: Bot) -> AsyncIOScheduler:
         id="reminder_job",
         replace_existing=True,
     )
+    scheduler.add_job(
+        log_cache_stats,
+        trigger="interval",
+        hours=1,
+        id="cache_stats_job",
+        replace_existing=True,
+    )
     scheduler.start()
     logger.info("Scheduler started.")
     return scheduler